@@ -11,6 +11,7 @@ tempfile: storing session
 werkzeug.security: adds function to store user's pass as hash
 werkzeug.exceptions: if any exception happens, use a function: errorhandler(e), and app.errorhandler
 datetime: store datetime when a message is sent
+time: pause between batches of the archive job
 wraps: used in login_required function
 """
 """
@@ -23,8 +24,9 @@ from flask_session import Session
 from tempfile import mkdtemp
 from werkzeug.security import check_password_hash, generate_password_hash
 from werkzeug.exceptions import default_exceptions, HTTPException, InternalServerError
-from datetime import datetime
+from datetime import datetime, timedelta
 from functools import wraps
+import time
 
 
 """Initiate app"""
@@ -87,11 +89,73 @@ CREATE TABLE messages (
         FOREIGN KEY (receiver_id) REFERENCES users (id),
         PRIMARY KEY(id)
     );
+
+CREATE TABLE cohort_digest (
+        user_id INTEGER NOT NULL,
+        digest_date DATE NOT NULL,
+        number_of_requests INTEGER NOT NULL,
+        number_of_unread_messages INTEGER NOT NULL,
+        FOREIGN KEY (user_id) REFERENCES users (id),
+        PRIMARY KEY(user_id)
+    );
+
+CREATE TABLE cohort_digest_potential_friends (
+        user_id INTEGER NOT NULL,
+        friend_id INTEGER NOT NULL,
+        friend_username TEXT NOT NULL,
+        FOREIGN KEY (user_id) REFERENCES users (id),
+        FOREIGN KEY (friend_id) REFERENCES users (id)
+    );
+
+CREATE INDEX cohort_digest_potential_friends_user_id ON cohort_digest_potential_friends (user_id);
+
+Archive database info (birthday-meet-archive.db, see archive_messages()):
+
+CREATE TABLE messages (same columns as messages above, ids are the archive's own);
 """
 
 """CONSTANTS"""
 MONTHS = [None,"Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"]
 DEFAULT_REQUEST_MESSAGE = "Hello, I would like to add you as my friend!"
+ARCHIVE_DATABASE = "birthday-meet-archive.db"
+# Read messages older than this many days are moved to the archive database
+ARCHIVE_AFTER_DAYS = int(os.environ.get("ARCHIVE_AFTER_DAYS", 90))
+# Move messages in small transactions and pause in between, so the app never waits long for the database
+ARCHIVE_BATCH_SIZE = 500
+ARCHIVE_BATCH_PAUSE = 0.1
+
+"""Access archive database, create it on first run (cs50 SQL only opens existing files)"""
+if not os.path.exists(ARCHIVE_DATABASE):
+    open(ARCHIVE_DATABASE, "w").close()
+archive_db = SQL("sqlite:///" + ARCHIVE_DATABASE)
+archive_db.execute("""CREATE TABLE IF NOT EXISTS messages (
+        id INTEGER,
+        sender_id INTEGER NOT NULL,
+        receiver_id INTEGER NOT NULL,
+        message_text TEXT NOT NULL,
+        when_sent DATE NOT NULL,
+        is_read BIT NOT NULL,
+        PRIMARY KEY(id)
+    )""")
+
+"""Create the birthday cohort digest tables on first run (see digest_cohort())"""
+db.execute("""CREATE TABLE IF NOT EXISTS cohort_digest (
+        user_id INTEGER NOT NULL,
+        digest_date DATE NOT NULL,
+        number_of_requests INTEGER NOT NULL,
+        number_of_unread_messages INTEGER NOT NULL,
+        FOREIGN KEY (user_id) REFERENCES users (id),
+        PRIMARY KEY(user_id)
+    )""")
+db.execute("""CREATE TABLE IF NOT EXISTS cohort_digest_potential_friends (
+        user_id INTEGER NOT NULL,
+        friend_id INTEGER NOT NULL,
+        friend_username TEXT NOT NULL,
+        FOREIGN KEY (user_id) REFERENCES users (id),
+        FOREIGN KEY (friend_id) REFERENCES users (id)
+    )""")
+db.execute("CREATE INDEX IF NOT EXISTS cohort_digest_potential_friends_user_id ON cohort_digest_potential_friends (user_id)")
+
 
 @app.after_request
 def after_request(response):
@@ -122,6 +186,28 @@ def login_required(f):
     return decorated_function
 
 
+def get_cohort_digest(user_id):
+    """Return today's digest row of user (see digest_cohort()), or None if user's birthday is not digested today
+    Pages fall back to querying the live tables when this is None
+    """
+    digest = db.execute("SELECT * FROM cohort_digest WHERE user_id = ? AND digest_date = ?", user_id, datetime.now().strftime("%Y-%m-%d"))
+    if len(digest) == 1:
+        return digest[0]
+    return None
+
+
+def add_potential_friend_to_digest(user_id, friend_id):
+    """Correct the digest after friend_id became a potential friend of user_id (does nothing if user_id is not digested)"""
+    if len(db.execute("SELECT * FROM cohort_digest WHERE user_id = ?", user_id)) == 1:
+        friend_username = db.execute("SELECT username FROM users WHERE id = ?", friend_id)[0]["username"]
+        db.execute("INSERT INTO cohort_digest_potential_friends (user_id, friend_id, friend_username) VALUES (?, ?, ?)", user_id, friend_id, friend_username)
+
+
+def remove_potential_friend_from_digest(user_id, friend_id):
+    """Correct the digest after friend_id is no longer a potential friend of user_id"""
+    db.execute("DELETE FROM cohort_digest_potential_friends WHERE user_id = ? AND friend_id = ?", user_id, friend_id)
+
+
 @app.route("/")
 def index():
     """Home page
@@ -135,6 +221,7 @@ def index():
             number of requests
             number of unread messages
             number of potential friends
+        on user's birthday the counts come from the cohort digest (see digest_cohort())
     HTML:
         overview.html will be receiving:
         username
@@ -156,15 +243,22 @@ def index():
         birth_day = user_info["day"]
         birth_month_name = MONTHS[birth_month]
 
-        # Count number of requests from db where receiver is user
-        number_of_requests = len(db.execute("SELECT * FROM requests WHERE receiver_id = ?", user_id))
+        digest = get_cohort_digest(user_id)
+        if digest:
+            # It's user's birthday, use the precomputed counts instead of querying with the rest of the cohort
+            number_of_requests = digest["number_of_requests"]
+            number_of_unread_messages = digest["number_of_unread_messages"]
+            number_of_potential_friends = db.execute("SELECT COUNT(*) AS n FROM cohort_digest_potential_friends WHERE user_id = ?", user_id)[0]["n"]
+        else:
+            # Count number of requests from db where receiver is user
+            number_of_requests = len(db.execute("SELECT * FROM requests WHERE receiver_id = ?", user_id))
 
-        # Count number of messages from db where receiver is user AND is_read is false
-        number_of_unread_messages = len(db.execute("SELECT * FROM messages WHERE receiver_id = ? AND is_read = 0", user_id))
+            # Count number of messages from db where receiver is user AND is_read is false
+            number_of_unread_messages = len(db.execute("SELECT * FROM messages WHERE receiver_id = ? AND is_read = 0", user_id))
 
-        # Potential friend is: id not user_id, month and day match, id not user_1 when user is user_2, id not user_2 when user is user_1, id not in requests where user's the sender
-        number_of_potential_friends = len(db.execute("SELECT * FROM users WHERE id != ? AND month = ? AND day = ? AND id NOT IN (SELECT user_1_id FROM friends WHERE user_2_id = ?) AND id NOT IN (SELECT user_2_id FROM friends WHERE user_1_id = ?) AND id NOT IN (SELECT receiver_id FROM requests WHERE sender_id = ?)",
-                                                     user_id, birth_month, birth_day, user_id, user_id, user_id))
+            # Potential friend is: id not user_id, month and day match, id not user_1 when user is user_2, id not user_2 when user is user_1, id not in requests where user's the sender
+            number_of_potential_friends = len(db.execute("SELECT * FROM users WHERE id != ? AND month = ? AND day = ? AND id NOT IN (SELECT user_1_id FROM friends WHERE user_2_id = ?) AND id NOT IN (SELECT user_2_id FROM friends WHERE user_1_id = ?) AND id NOT IN (SELECT receiver_id FROM requests WHERE sender_id = ?)",
+                                                         user_id, birth_month, birth_day, user_id, user_id, user_id))
 
         # Render the template with all necessary info to display in overview.html
         return render_template("overview.html",
@@ -294,10 +388,16 @@ def register():
                             day = int(day)
                             # Proceed if month and day match
                             if (month in [1, 3, 5, 7, 8, 10, 12] and 1 <= day <= 31) or (month in [4, 6, 9, 11] and 1 <= day <= 30) or (month == 2 and 1 <= day <= 29):
+                                # Change and its digest correction in one transaction, so digest_cohort() never runs between them
+                                db.execute("BEGIN TRANSACTION")
                                 # Insert new user data into db
                                 db.execute("INSERT INTO users (username, hash, month, day) VALUES (?, ?, ?, ?)", username, generate_password_hash(request.form.get("password")), month, day)
                                 # Auto login user
                                 session["user_id"] = db.execute("SELECT * FROM users WHERE username = ?", username)[0]["id"]
+                                # New user is a potential friend of everyone digested with the same birthday
+                                db.execute("INSERT INTO cohort_digest_potential_friends (user_id, friend_id, friend_username) SELECT cohort_digest.user_id, ?, ? FROM cohort_digest JOIN users ON users.id = cohort_digest.user_id WHERE users.month = ? AND users.day = ? AND users.id != ?",
+                                           session.get("user_id"), username, month, day, session.get("user_id"))
+                                db.execute("COMMIT")
                                 # TODO: add flash message
                                 flash("Registration complete!")
                                 return redirect("/")
@@ -364,6 +464,7 @@ def explore():
             error
 
     have a 100-char limit to message
+    On user's birthday the list comes from the cohort digest (see digest_cohort())
     """
     if request.method == "POST":
         receiver_id = request.form.get("receiver_id")
@@ -386,7 +487,13 @@ def explore():
                         if len(db.execute("SELECT * FROM requests WHERE sender_id = ? AND receiver_id = ?", receiver_id, session.get("user_id"))) > 0:
                             # add this relationship to friend list, remove that request from list
                             db.execute("INSERT INTO friends (user_1_id, user_2_id) VALUES (?, ?)", session.get("user_id"), receiver_id)
-                            db.execute("DELETE FROM requests WHERE sender_id = ? AND receiver_id = ?", receiver_id, session.get("user_id"))
+                            # Only correct the digest if this POST is the one that removed the request (not a double submit)
+                            # Change and its digest correction in one transaction, so digest_cohort() never runs between them
+                            db.execute("BEGIN TRANSACTION")
+                            if db.execute("DELETE FROM requests WHERE sender_id = ? AND receiver_id = ?", receiver_id, session.get("user_id")) == 1:
+                                db.execute("UPDATE cohort_digest SET number_of_requests = number_of_requests - 1 WHERE user_id = ?", session.get("user_id"))
+                            remove_potential_friend_from_digest(session.get("user_id"), receiver_id)
+                            db.execute("COMMIT")
                             # TODO: add flash message
                             flash("This user have already sent you a request, you are now friends!")
                             return redirect("/explore")
@@ -399,7 +506,12 @@ def explore():
                             if len(message) <= 100:
                                 # Keep track of when is this request sent
                                 now = datetime.now().strftime("%Y-%m-%d")
+                                # Change and its digest correction in one transaction, so digest_cohort() never runs between them
+                                db.execute("BEGIN TRANSACTION")
                                 db.execute("INSERT INTO requests (sender_id, receiver_id, request_message, when_sent) VALUES (?, ?, ?, ?)", session.get("user_id"), receiver_id, message, now)
+                                db.execute("UPDATE cohort_digest SET number_of_requests = number_of_requests + 1 WHERE user_id = ?", receiver_id)
+                                remove_potential_friend_from_digest(session.get("user_id"), receiver_id)
+                                db.execute("COMMIT")
                                 # TODO: add flash message
                                 flash("Request sent successfully!")
                                 return redirect("/explore")
@@ -419,6 +531,11 @@ def explore():
             # receiver_id doesnt exist, receiver is user him/herself, or receiver doesn't exist in users list
             flash("Error: Invalid friend request")
 
+    if get_cohort_digest(session.get("user_id")):
+        # It's user's birthday, use the precomputed list instead of checking every user in the cohort
+        list_of_potential_friends = db.execute("SELECT friend_id AS id, friend_username AS username FROM cohort_digest_potential_friends WHERE user_id = ? ORDER BY friend_username", session.get("user_id"))
+        return render_template("explore.html", list_of_potential_friends=list_of_potential_friends)
+
     list_of_potential_friends = []
     current_user_info = db.execute("SELECT * FROM users WHERE id = ?", session.get("user_id"))[0]
     month = current_user_info["month"]
@@ -491,10 +608,20 @@ def requests():
                 if request_info["receiver_id"] == session.get("user_id"):
                     # Get sender's id, and remove the request from requests table
                     sender_id = request_info["sender_id"]
-                    db.execute("DELETE FROM requests WHERE id = ?", request_id)
+                    # Only correct the digest if this POST is the one that removed the request (not a double submit)
+                    # Change and its digest correction in one transaction, so digest_cohort() never runs between them
+                    db.execute("BEGIN TRANSACTION")
+                    request_deleted = (db.execute("DELETE FROM requests WHERE id = ?", request_id) == 1)
+                    if request_deleted:
+                        db.execute("UPDATE cohort_digest SET number_of_requests = number_of_requests - 1 WHERE user_id = ?", session.get("user_id"))
+                        if accepts != "true":
+                            # Request is gone without becoming friends, sender may send another request
+                            add_potential_friend_to_digest(sender_id, session.get("user_id"))
+                    db.execute("COMMIT")
                     if accepts == "true":
                         # This request is accepted, add them into friend list
                         db.execute("INSERT INTO friends (user_1_id, user_2_id) VALUES (?, ?)", session.get("user_id"), sender_id)
+                        remove_potential_friend_from_digest(session.get("user_id"), sender_id)
                         # TODO: flash
                         flash("Request accepted!")
                         return redirect("/requests")
@@ -533,9 +660,12 @@ def messages():
         if yes, mark as read, change to db, then simply redirect back to messages
 
     GET request displays all messages, including sender, send time, read/unread... if it's unread, include a button to set it as read.
+        only messages in the main database are shown, unless "?older=1" is given,
+        then messages moved to the archive database are merged in and sorted by when_sent with them (archived ones are all read)
     HTML:
         get: pass on a list of messages (each is a dict with message, id of message (for post requests), sender username, sent time, is_read (true or false))
             (list_of_messages_info =>message, id, sender_username, time_sent, is_read)
+            and showing_older (true if archived messages are included)
         post: app.py receives the id of the message to "mark as read" (message_id)
     """
     if request.method == "POST":
@@ -546,7 +676,12 @@ def messages():
             if len(message) == 1:
                 if message[0]["is_read"] == 0:
                     # Update message as read
-                    db.execute("UPDATE messages SET is_read = 1 WHERE id = ? AND receiver_id = ?", id_of_message_to_mark, session.get("user_id"))
+                    # Only correct the digest if this POST is the one that marked it as read (not a double submit)
+                    # Change and its digest correction in one transaction, so digest_cohort() never runs between them
+                    db.execute("BEGIN TRANSACTION")
+                    if db.execute("UPDATE messages SET is_read = 1 WHERE id = ? AND receiver_id = ? AND is_read = 0", id_of_message_to_mark, session.get("user_id")) == 1:
+                        db.execute("UPDATE cohort_digest SET number_of_unread_messages = number_of_unread_messages - 1 WHERE user_id = ?", session.get("user_id"))
+                    db.execute("COMMIT")
                     # TODO: flash
                     flash("Message marked as read!")
                     return redirect("/messages")
@@ -563,6 +698,12 @@ def messages():
     list_of_messages_info = []
     # Get necessary info
     list_of_messages_from_database = db.execute("SELECT * FROM messages WHERE receiver_id = ?", session.get("user_id"))
+    showing_older = request.args.get("older") == "1"
+    if showing_older:
+        # Unread messages and messages read after the last archive run stay in the main database, so they can be older than archived ones
+        # Sort by date (list is reversed later), the sort is stable so each database's messages keep their id order within a day
+        list_of_messages_from_database = archive_db.execute("SELECT * FROM messages WHERE receiver_id = ? ORDER BY id", session.get("user_id")) + list_of_messages_from_database
+        list_of_messages_from_database.sort(key = lambda l: l["when_sent"])
     for message_from_database in list_of_messages_from_database:
         # From db get username of sender
         sender_username = db.execute("SELECT * FROM users WHERE id = ?", message_from_database["sender_id"])[0]["username"]
@@ -577,7 +718,7 @@ def messages():
         })
     # Reverse so newest comes first
     list_of_messages_info.reverse()
-    return render_template("messages.html", list_of_messages_info=list_of_messages_info)
+    return render_template("messages.html", list_of_messages_info=list_of_messages_info, showing_older=showing_older)
 
 
 @app.route("/friends")
@@ -602,11 +743,20 @@ def friends():
 @app.route("/sent")
 @login_required
 def sent():
-    """Display list of all messages sent by user"""
+    """Display list of all messages sent by user
+
+    Same as messages(), archived messages are only included with "?older=1"
+    """
     # Init a list to return later
     list_of_messages_info = []
     # Get necessary info
     list_of_messages_from_database = db.execute("SELECT * FROM messages WHERE sender_id = ?", session.get("user_id"))
+    showing_older = request.args.get("older") == "1"
+    if showing_older:
+        # Unread messages and messages read after the last archive run stay in the main database, so they can be older than archived ones
+        # Sort by date (list is reversed later), the sort is stable so each database's messages keep their id order within a day
+        list_of_messages_from_database = archive_db.execute("SELECT * FROM messages WHERE sender_id = ? ORDER BY id", session.get("user_id")) + list_of_messages_from_database
+        list_of_messages_from_database.sort(key = lambda l: l["when_sent"])
     for message_from_database in list_of_messages_from_database:
         # From db get username of receiver
         receiver_username = db.execute("SELECT * FROM users WHERE id = ?", message_from_database["receiver_id"])[0]["username"]
@@ -621,7 +771,7 @@ def sent():
         })
     # Reverse so newest comes first
     list_of_messages_info.reverse()
-    return render_template("sent.html", list_of_messages_info=list_of_messages_info)
+    return render_template("sent.html", list_of_messages_info=list_of_messages_info, showing_older=showing_older)
 
 
 @app.route("/send", methods=["GET", "POST"])
@@ -655,7 +805,11 @@ def send():
                 if message_text:
                     # Add message to db, and redirect with flash
                     now = datetime.now().strftime("%Y-%m-%d")
+                    # Change and its digest correction in one transaction, so digest_cohort() never runs between them
+                    db.execute("BEGIN TRANSACTION")
                     db.execute("INSERT INTO messages (sender_id, receiver_id, message_text, when_sent, is_read) VALUES (?, ?, ?, ?, 0)", session.get("user_id"), receiver_id, message_text, now)
+                    db.execute("UPDATE cohort_digest SET number_of_unread_messages = number_of_unread_messages + 1 WHERE user_id = ?", receiver_id)
+                    db.execute("COMMIT")
                     flash("Message successfully sent!")
                     return redirect("/sent")
                 else:
@@ -720,3 +874,62 @@ def contact():
             # No message is sent
             error_message = "Please enter your message to send"
     return render_template("contact.html", error_message=error_message)
+
+
+@app.cli.command("archive-messages")
+def archive_messages():
+    """Move read messages older than ARCHIVE_AFTER_DAYS days into the archive database
+
+    Run with "flask archive-messages", e.g. nightly from cron.
+    The archive database is attached to the main database so each batch is copied and deleted in one transaction,
+        a batch is at most ARCHIVE_BATCH_SIZE messages, and the job pauses between batches to let the app write
+    Unread messages are never archived, so marking a message as read only ever touches the main database
+    """
+    cutoff = (datetime.now() - timedelta(days=ARCHIVE_AFTER_DAYS)).strftime("%Y-%m-%d")
+    db.execute("ATTACH DATABASE ? AS archive", ARCHIVE_DATABASE)
+    number_of_archived_messages = 0
+    while True:
+        # Find the last id of the next batch (oldest messages first)
+        batch = db.execute("SELECT id FROM messages WHERE is_read = 1 AND when_sent < ? ORDER BY id LIMIT ?", cutoff, ARCHIVE_BATCH_SIZE)
+        if len(batch) == 0:
+            break
+        last_id = batch[-1]["id"]
+        # Copy then delete the same rows in one transaction, so a message is never lost or in both databases
+        db.execute("BEGIN TRANSACTION")
+        db.execute("INSERT INTO archive.messages (sender_id, receiver_id, message_text, when_sent, is_read) SELECT sender_id, receiver_id, message_text, when_sent, is_read FROM messages WHERE is_read = 1 AND when_sent < ? AND id <= ? ORDER BY id",
+                   cutoff, last_id)
+        number_of_archived_messages += db.execute("DELETE FROM messages WHERE is_read = 1 AND when_sent < ? AND id <= ?", cutoff, last_id)
+        db.execute("COMMIT")
+        time.sleep(ARCHIVE_BATCH_PAUSE)
+    db.execute("DETACH DATABASE archive")
+    print(f"Archived {number_of_archived_messages} messages older than {cutoff}")
+
+
+@app.cli.command("digest-cohort")
+def digest_cohort():
+    """Precompute the digest of everyone whose birthday is tomorrow
+
+    Run with "flask digest-cohort" shortly before midnight, e.g. from cron.
+    On their birthday, the whole cohort visits "/" and "/explore" at once,
+        so their overview counts and potential friends are computed here in a few queries instead
+    Digest (for each user in the cohort):
+        cohort_digest: number_of_requests, number_of_unread_messages
+        cohort_digest_potential_friends: id and username of every potential friend
+    Routes that change these (register, explore, requests, messages, send) correct the digest as they go
+    Digests of past days are removed, today's is kept until the next run
+    """
+    today = datetime.now().strftime("%Y-%m-%d")
+    tomorrow = datetime.now() + timedelta(days=1)
+    digest_date = tomorrow.strftime("%Y-%m-%d")
+    # Replace the digests in one transaction, so pages never see half a cohort
+    db.execute("BEGIN TRANSACTION")
+    db.execute("DELETE FROM cohort_digest_potential_friends WHERE user_id IN (SELECT user_id FROM cohort_digest WHERE digest_date != ?)", today)
+    db.execute("DELETE FROM cohort_digest WHERE digest_date != ?", today)
+    db.execute("INSERT INTO cohort_digest (user_id, digest_date, number_of_requests, number_of_unread_messages) SELECT id, ?, (SELECT COUNT(*) FROM requests WHERE receiver_id = users.id), (SELECT COUNT(*) FROM messages WHERE receiver_id = users.id AND is_read = 0) FROM users WHERE month = ? AND day = ?",
+               digest_date, tomorrow.month, tomorrow.day)
+    # Same definition of potential friend as index() and explore()
+    db.execute("INSERT INTO cohort_digest_potential_friends (user_id, friend_id, friend_username) SELECT member.id, friend.id, friend.username FROM users AS member JOIN users AS friend ON friend.month = member.month AND friend.day = member.day AND friend.id != member.id WHERE member.month = ? AND member.day = ? AND friend.id NOT IN (SELECT user_1_id FROM friends WHERE user_2_id = member.id) AND friend.id NOT IN (SELECT user_2_id FROM friends WHERE user_1_id = member.id) AND friend.id NOT IN (SELECT receiver_id FROM requests WHERE sender_id = member.id)",
+               tomorrow.month, tomorrow.day)
+    db.execute("COMMIT")
+    number_of_users = db.execute("SELECT COUNT(*) AS n FROM cohort_digest WHERE digest_date = ?", digest_date)[0]["n"]
+    print(f"Digested {number_of_users} users with birthday {MONTHS[tomorrow.month]} {tomorrow.day}")